@@ -1,18 +1,24 @@
 import os
-import json
+import re
+import sqlite3
+import orjson
 import asyncio
+import tempfile
 import time
 from datetime import datetime
 from typing import List, Dict, Optional
-from collections import defaultdict
+from collections import OrderedDict
+from array import array
 import threading
+import numpy as np
 from flask import Flask, jsonify
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.filters import Command
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, Message
 from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramRetryAfter
 from rapidfuzz import fuzz, process
-from Levenshtein import distance as levenshtein_distance
+from rapidfuzz.distance import Levenshtein
 
 try:
     from s3_storage import load_movies_from_s3, save_movies_to_s3
@@ -33,7 +39,7 @@ WEB_SERVER_PORT = int(os.environ.get("PORT", 8080))
 if not BOT_TOKEN:
     raise ValueError("BOT_TOKEN environment variable is not set")
 
-ADMIN_IDS = [7263519581]
+ADMIN_IDS = frozenset({7263519581})
 
 LIBRARY_CHANNEL_USERNAME = "@MOVIEMAZA19"
 LIBRARY_CHANNEL_ID = -1002970735025
@@ -42,29 +48,63 @@ JOIN_CHANNEL_ID = -1003124931164
 JOIN_GROUP_USERNAME = "@THEGREATMOVIESL9"
 JOIN_GROUP_ID = -1002970735025
 
+LIBRARY_CHANNEL_NAME = LIBRARY_CHANNEL_USERNAME.lstrip('@').lower()
+JOIN_KEYBOARD = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text=f"🔗 Join Channel", url=f"https://t.me/{JOIN_CHANNEL_USERNAME.lstrip('@')}")],
+    [InlineKeyboardButton(text=f"👥 Join Group", url=f"https://t.me/{JOIN_GROUP_USERNAME.lstrip('@')}")],
+    [InlineKeyboardButton(text="✅ I Joined", callback_data="joined")]
+])
+
 import platform
 
 if platform.system() == "Linux" and os.path.exists("/tmp"):
     MOVIES_FILE = "/tmp/movies.json"
     BACKUP_FILE = "/tmp/movies_backup.json"
     USERS_FILE = "/tmp/users.json"
+    USERS_DB_FILE = "/tmp/users.db"
+    MOVIES_JOURNAL_FILE = "/tmp/movies_journal.jsonl"
     INITIAL_DATA_FILE = "movies.json"
 else:
     MOVIES_FILE = "movies.json"
     BACKUP_FILE = "movies_backup.json"
     USERS_FILE = "users.json"
+    USERS_DB_FILE = "users.db"
+    MOVIES_JOURNAL_FILE = "movies_journal.jsonl"
     INITIAL_DATA_FILE = None
 
 bot = Bot(token=BOT_TOKEN)
 dp = Dispatcher()
 
 movies_cache: List[Dict[str, str]] = []
-movies_index: Dict[str, List[int]] = {}
-user_sessions: Dict[int, Dict] = defaultdict(dict)
-search_cache: Dict[str, List[Dict]] = {}
+movies_index: Dict[str, array] = {}
+_index_words: List[str] = []
+_normalized_titles: List[str] = []
+# Distinct title words, each title's words stored as ids into it: title i owns
+# _title_word_ids[_title_word_starts[i]:_title_word_starts[i + 1]]
+_vocab: List[str] = []
+_vocab_ids: Dict[str, int] = {}
+_title_word_ids = array('i')
+_title_word_starts = array('i', [0])
+_titles_lower: set = set()
+# Every character seen in a title gets one bit, so a title's character set is a single int
+_char_bits: Dict[str, int] = {}
+_title_char_masks: List[int] = []
+_title_consonants: List[str] = []
+_title_vowels: List[str] = []
+_title_sounds: List[str] = []
+user_sessions: "OrderedDict[int, Dict]" = OrderedDict()
+# Ranked (movie index, score) pairs; result dicts and buttons are rebuilt on a hit
+search_cache: "OrderedDict[tuple, List[tuple]]" = OrderedDict()
+# Part of every search cache key, bumping it retires all cached results at once
+_catalog_generation = 0
 verified_users: set = set()
 users_database: Dict[int, Dict] = {}
-user_last_action: Dict[int, float] = {}
+user_last_action: "OrderedDict[int, float]" = OrderedDict()
+_dirty_user_ids: set = set()
+_movies_dirty = False
+# /refresh reads running in worker threads; while any is, the journal must not be trimmed
+_refreshes_in_progress = 0
+_flush_task: Optional[asyncio.Task] = None
 bot_stats = {
     "start_time": time.time(),
     "total_searches": 0,
@@ -72,319 +112,563 @@ bot_stats = {
 }
 
 RATE_LIMIT_SECONDS = 1
+FLUSH_INTERVAL = 30
+BROADCAST_CONCURRENCY = 25
+BROADCAST_RETRIES = 3
+SEARCH_CACHE_SIZE = 1000
+USER_SESSIONS_SIZE = 10000
+
+_TOKEN_RE = re.compile(r'[^\W_]+')
+
+
+def _char_mask(text: str) -> int:
+    mask = 0
+    for c in set(text.replace(' ', '')):
+        bit = _char_bits.get(c)
+        if bit is None:
+            bit = _char_bits[c] = 1 << len(_char_bits)
+        mask |= bit
+    return mask
+
+
+def _index_movie(idx: int):
+    title_lower = movies_cache[idx]['title'].lower()
+    title_normalized = normalize_abbreviations(title_lower)
+    _titles_lower.add(title_lower)
+    _normalized_titles.append(title_normalized)
+    for word in dict.fromkeys(title_normalized.split()):
+        word_id = _vocab_ids.get(word)
+        if word_id is None:
+            word_id = _vocab_ids[word] = len(_vocab)
+            _vocab.append(word)
+        _title_word_ids.append(word_id)
+    _title_word_starts.append(len(_title_word_ids))
+    _title_char_masks.append(_char_mask(title_normalized))
+    consonants, vowels, sound = phonetic_keys(title_normalized)
+    _title_consonants.append(consonants)
+    _title_vowels.append(vowels)
+    _title_sounds.append(sound)
+    for word in dict.fromkeys(_TOKEN_RE.findall(title_normalized)):
+        if len(word) > 2:
+            if word not in movies_index:
+                movies_index[word] = array('i')
+                _index_words.append(word)
+            movies_index[word].append(idx)
 
 
 def build_movies_index():
-    global movies_index
+    global movies_index, _index_words, _normalized_titles, _titles_lower
+    global _vocab, _vocab_ids, _title_word_ids, _title_word_starts
+    global _char_bits, _title_char_masks, _title_consonants, _title_vowels, _title_sounds
     movies_index = {}
-    for idx, movie in enumerate(movies_cache):
-        title_normalized = normalize_abbreviations(movie['title'].lower())
-        words = title_normalized.split()
+    _index_words = []
+    _normalized_titles = []
+    _vocab = []
+    _vocab_ids = {}
+    _title_word_ids = array('i')
+    _title_word_starts = array('i', [0])
+    _titles_lower = set()
+    _char_bits = {}
+    _title_char_masks = []
+    _title_consonants = []
+    _title_vowels = []
+    _title_sounds = []
+    for idx in range(len(movies_cache)):
+        _index_movie(idx)
+
+
+def index_candidates(query_normalized: str) -> Optional[List[int]]:
+    tokens = [tok for tok in _TOKEN_RE.findall(query_normalized) if len(tok) > 2]
+    if not tokens:
+        return None
+    
+    candidates = set()
+    for tok in tokens:
+        words = [tok] if tok in movies_index else []
+        if len(tok) > 3:
+            # Pull in index words one edit away so a typo still reaches its titles
+            words += [word for word, _, _ in process.extract(
+                tok, _index_words, scorer=Levenshtein.distance, score_cutoff=1, limit=None
+            ) if word != tok]
+        if not words:
+            # Nothing close in the index, only a full scan can still match this word
+            return None
         for word in words:
-            if len(word) > 2:
-                if word not in movies_index:
-                    movies_index[word] = []
-                movies_index[word].append(idx)
+            candidates.update(movies_index[word])
+    return sorted(candidates)
 
 
-def load_movies():
-    global movies_cache
-    
+def write_file_atomic(path: str, data: bytes):
+    # Readers and a crash mid-write see either the old file or the new one, never half of it;
+    # each call gets its own temp file so concurrent writers cannot interleave
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix=os.path.basename(path) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def read_movies() -> List[Dict]:
     if S3_ENABLED:
         s3_movies = load_movies_from_s3()
         if s3_movies is not None:
-            movies_cache = s3_movies
-            with open(MOVIES_FILE, 'w', encoding='utf-8') as f:
-                json.dump(movies_cache, f, ensure_ascii=False, separators=(',', ':'))
-            build_movies_index()
-            return
+            movies = s3_movies
+            write_file_atomic(MOVIES_FILE, orjson.dumps(movies))
+            replay_movies_journal(movies)
+            return movies
     
     try:
         if os.path.exists(MOVIES_FILE):
-            with open(MOVIES_FILE, 'r', encoding='utf-8') as f:
-                movies_cache = json.load(f)
-                print(f"Loaded {len(movies_cache)} movies from {MOVIES_FILE}")
+            with open(MOVIES_FILE, 'rb') as f:
+                movies = orjson.loads(f.read())
+                print(f"Loaded {len(movies)} movies from {MOVIES_FILE}")
         elif INITIAL_DATA_FILE and os.path.exists(INITIAL_DATA_FILE):
-            with open(INITIAL_DATA_FILE, 'r', encoding='utf-8') as f:
-                movies_cache = json.load(f)
-            save_movies()
-            print(f"Loaded {len(movies_cache)} movies from {INITIAL_DATA_FILE} and saved to {MOVIES_FILE}")
+            with open(INITIAL_DATA_FILE, 'rb') as f:
+                movies = orjson.loads(f.read())
+            save_movies(movies)
+            print(f"Loaded {len(movies)} movies from {INITIAL_DATA_FILE} and saved to {MOVIES_FILE}")
         else:
-            movies_cache = []
-            save_movies()
+            movies = []
+            save_movies(movies)
             print(f"Created new {MOVIES_FILE}")
-    except json.JSONDecodeError:
+    except orjson.JSONDecodeError:
         print(f"Error: Corrupted {MOVIES_FILE}, attempting recovery from backup")
         if os.path.exists(BACKUP_FILE):
-            with open(BACKUP_FILE, 'r', encoding='utf-8') as f:
-                movies_cache = json.load(f)
-            save_movies()
+            with open(BACKUP_FILE, 'rb') as f:
+                movies = orjson.loads(f.read())
+            save_movies(movies)
         elif INITIAL_DATA_FILE and os.path.exists(INITIAL_DATA_FILE):
-            with open(INITIAL_DATA_FILE, 'r', encoding='utf-8') as f:
-                movies_cache = json.load(f)
-            save_movies()
+            with open(INITIAL_DATA_FILE, 'rb') as f:
+                movies = orjson.loads(f.read())
+            save_movies(movies)
         else:
-            movies_cache = []
-            save_movies()
+            movies = []
+            save_movies(movies)
     except Exception as e:
         print(f"Error loading movies: {e}")
-        movies_cache = []
+        movies = []
     
+    replay_movies_journal(movies)
+    return movies
+
+
+def load_movies(movies: Optional[List[Dict]] = None):
+    global movies_cache
+    movies_cache = read_movies() if movies is None else movies
     build_movies_index()
     print(f"Built search index with {len(movies_index)} unique terms")
 
 
-def save_movies():
+def save_movies(movies: Optional[List[Dict]] = None) -> bool:
+    if movies is None:
+        movies = movies_cache
     try:
         if os.path.exists(MOVIES_FILE):
-            with open(MOVIES_FILE, 'r', encoding='utf-8') as f:
+            with open(MOVIES_FILE, 'rb') as f:
                 backup_data = f.read()
-            with open(BACKUP_FILE, 'w', encoding='utf-8') as f:
-                f.write(backup_data)
+            write_file_atomic(BACKUP_FILE, backup_data)
         
-        with open(MOVIES_FILE, 'w', encoding='utf-8') as f:
-            json.dump(movies_cache, f, ensure_ascii=False, separators=(',', ':'))
-        print(f"Saved {len(movies_cache)} movies to {MOVIES_FILE}")
+        write_file_atomic(MOVIES_FILE, orjson.dumps(movies))
+        print(f"Saved {len(movies)} movies to {MOVIES_FILE}")
         
         if S3_ENABLED:
-            save_movies_to_s3(movies_cache)
+            save_movies_to_s3(movies)
+        return True
     except Exception as e:
         print(f"Error saving movies: {e}")
+        return False
+
+
+def write_movies_journal(movies: List[Dict], append: bool = True):
+    data = b''.join(orjson.dumps(movie, option=orjson.OPT_APPEND_NEWLINE) for movie in movies)
+    try:
+        if append:
+            with open(MOVIES_JOURNAL_FILE, 'ab') as f:
+                f.write(data)
+        else:
+            # The rewrite holds movies not yet in any saved snapshot, so it must never be torn
+            write_file_atomic(MOVIES_JOURNAL_FILE, data)
+    except Exception as e:
+        print(f"Error writing {MOVIES_JOURNAL_FILE}: {e}")
+
+
+def replay_movies_journal(movies: List[Dict]):
+    global _movies_dirty
+    if not os.path.exists(MOVIES_JOURNAL_FILE):
+        return
+    
+    known_titles = {movie['title'].lower() for movie in movies}
+    replayed = 0
+    try:
+        with open(MOVIES_JOURNAL_FILE, 'rb') as f:
+            for line in f:
+                try:
+                    movie = orjson.loads(line)
+                except orjson.JSONDecodeError:
+                    # Blank line or a write torn by a crash
+                    continue
+                if movie['title'].lower() not in known_titles:
+                    known_titles.add(movie['title'].lower())
+                    movies.append(movie)
+                    replayed += 1
+    except Exception as e:
+        print(f"Error replaying {MOVIES_JOURNAL_FILE}: {e}")
+    
+    if replayed:
+        _movies_dirty = True
+        print(f"Replayed {replayed} movies from {MOVIES_JOURNAL_FILE}")
+
+
+def connect_users_db() -> sqlite3.Connection:
+    conn = sqlite3.connect(USERS_DB_FILE)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
 
 
 def load_users():
     global users_database
     try:
-        if os.path.exists(USERS_FILE):
-            with open(USERS_FILE, 'r', encoding='utf-8') as f:
-                users_database = json.load(f)
-            print(f"Loaded {len(users_database)} users from {USERS_FILE}")
-        else:
-            users_database = {}
-            save_users()
-            print(f"Created new {USERS_FILE}")
+        conn = connect_users_db()
+        try:
+            conn.execute("""CREATE TABLE IF NOT EXISTS users (
+                user_id INTEGER PRIMARY KEY,
+                username TEXT,
+                first_name TEXT,
+                joined_date TEXT,
+                last_active TEXT
+            )""")
+            rows = conn.execute("SELECT user_id, username, first_name, joined_date, last_active FROM users").fetchall()
+        finally:
+            conn.close()
+        users_database = {
+            str(user_id): {
+                "user_id": user_id,
+                "username": username,
+                "first_name": first_name,
+                "joined_date": joined_date,
+                "last_active": last_active
+            }
+            for user_id, username, first_name, joined_date, last_active in rows
+        }
+        print(f"Loaded {len(users_database)} users from {USERS_DB_FILE}")
+        
+        if not users_database and os.path.exists(USERS_FILE):
+            with open(USERS_FILE, 'rb') as f:
+                users_database = orjson.loads(f.read())
+            save_users(list(users_database.values()))
+            print(f"Migrated {len(users_database)} users from {USERS_FILE}")
     except Exception as e:
         print(f"Error loading users: {e}")
         users_database = {}
 
 
-def save_users():
+def save_users(users: List[Dict]) -> bool:
     try:
-        with open(USERS_FILE, 'w', encoding='utf-8') as f:
-            json.dump(users_database, f, ensure_ascii=False, separators=(',', ':'))
-        print(f"Saved {len(users_database)} users to {USERS_FILE}")
+        conn = connect_users_db()
+        try:
+            with conn:
+                conn.executemany(
+                    "INSERT INTO users (user_id, username, first_name, joined_date, last_active) "
+                    "VALUES (:user_id, :username, :first_name, :joined_date, :last_active) "
+                    "ON CONFLICT(user_id) DO UPDATE SET last_active = excluded.last_active",
+                    users
+                )
+        finally:
+            conn.close()
+        print(f"Saved {len(users)} users to {USERS_DB_FILE}")
+        return True
     except Exception as e:
         print(f"Error saving users: {e}")
+        return False
+
+
+async def flush_users():
+    if not _dirty_user_ids:
+        return
+    # Copy the touched rows on the loop, the writer thread only upserts those
+    dirty_ids = list(_dirty_user_ids)
+    _dirty_user_ids.clear()
+    if not await asyncio.to_thread(save_users, [dict(users_database[user_id_str]) for user_id_str in dirty_ids]):
+        _dirty_user_ids.update(dirty_ids)
+
+
+async def flush_movies():
+    global _movies_dirty
+    if not _movies_dirty:
+        return
+    _movies_dirty = False
+    cache = movies_cache
+    snapshot = list(cache)
+    if not await asyncio.to_thread(save_movies, snapshot):
+        _movies_dirty = True
+    elif movies_cache is cache and not _refreshes_in_progress:
+        # Movies added while the snapshot was being written stay journaled
+        write_movies_journal(movies_cache[len(snapshot):], append=False)
+    else:
+        # A /refresh read may not include this snapshot, keep the whole journal for it to replay
+        # and save whichever list ends up swapped in next round
+        _movies_dirty = True
+
+
+async def periodic_flush():
+    while True:
+        await asyncio.sleep(FLUSH_INTERVAL)
+        await flush_users()
+        await flush_movies()
 
 
 def add_user(user_id: int, username: str = None, first_name: str = None):
     user_id_str = str(user_id)
+    now_iso = datetime.now().isoformat()
     if user_id_str not in users_database:
         users_database[user_id_str] = {
             "user_id": user_id,
             "username": username,
             "first_name": first_name,
-            "joined_date": datetime.now().isoformat(),
-            "last_active": datetime.now().isoformat()
+            "joined_date": now_iso,
+            "last_active": now_iso
         }
-        save_users()
         print(f"New user added: {user_id} (@{username})")
     else:
-        users_database[user_id_str]["last_active"] = datetime.now().isoformat()
-        save_users()
+        users_database[user_id_str]["last_active"] = now_iso
+    _dirty_user_ids.add(user_id_str)
 
 
 def add_movie(title: str, file_id: str) -> bool:
+    global _movies_dirty, _catalog_generation
     normalized_title = title.strip().lower()
-    for movie in movies_cache:
-        if movie['title'].lower() == normalized_title:
-            print(f"Duplicate movie prevented: {title}")
-            return False
+    if normalized_title in _titles_lower:
+        print(f"Duplicate movie prevented: {title}")
+        return False
     
-    movies_cache.append({"title": title, "file_id": file_id})
-    save_movies()
-    build_movies_index()
-    search_cache.clear()
+    movie = {"title": title, "file_id": file_id}
+    movies_cache.append(movie)
+    _index_movie(len(movies_cache) - 1)
+    # Append-only journal now, full rewrite and S3 upload on the next flush
+    write_movies_journal([movie])
+    _movies_dirty = True
+    _catalog_generation += 1
     print(f"Added new movie: {title}")
     return True
 
 
-def normalize_abbreviations(text: str) -> str:
-    abbrev_map = {
-        r'\bs(\d+)\b': r'season \1',
-        r'\bse(\d+)\b': r'season \1',
-        r'\bseason(\d+)\b': r'season \1',
-        r'\bpt(\d+)\b': r'part \1',
-        r'\bpart(\d+)\b': r'part \1',
-        r'\bep(\d+)\b': r'episode \1',
-        r'\bepisode(\d+)\b': r'episode \1',
-        r'\be(\d+)\b': r'episode \1',
-        r'\bvol(\d+)\b': r'volume \1',
-        r'\bvolume(\d+)\b': r'volume \1',
-        r'\bch(\d+)\b': r'chapter \1',
-        r'\bchapter(\d+)\b': r'chapter \1',
-    }
-    
-    import re
-    normalized = text.lower()
-    for pattern, replacement in abbrev_map.items():
-        normalized = re.sub(pattern, replacement, normalized)
-    return normalized
+_ABBREV_RE = re.compile(r'\b(season|se|s|part|pt|episode|ep|e|volume|vol|chapter|ch)(\d+)\b')
+_ABBREV_CANON = {
+    's': 'season', 'se': 'season', 'season': 'season',
+    'pt': 'part', 'part': 'part',
+    'ep': 'episode', 'episode': 'episode', 'e': 'episode',
+    'vol': 'volume', 'volume': 'volume',
+    'ch': 'chapter', 'chapter': 'chapter',
+}
 
 
-def phonetic_similarity(s1: str, s2: str) -> float:
-    s1_lower = s1.lower()
-    s2_lower = s2.lower()
-    
-    consonants = "bcdfghjklmnpqrstvwxyz"
-    vowels = "aeiou"
-    
-    def extract_consonants(s):
-        return ''.join([c for c in s if c in consonants])
-    
-    def extract_vowels(s):
-        return ''.join([c for c in s if c in vowels])
-    
-    cons1, cons2 = extract_consonants(s1_lower), extract_consonants(s2_lower)
-    vowel1, vowel2 = extract_vowels(s1_lower), extract_vowels(s2_lower)
-    
-    if len(cons1) == 0 or len(cons2) == 0:
-        return 0
-    
-    cons_sim = fuzz.ratio(cons1, cons2)
-    vowel_sim = fuzz.ratio(vowel1, vowel2) if vowel1 and vowel2 else 50
-    
-    return (cons_sim * 0.7 + vowel_sim * 0.3)
+def _expand_abbreviation(match: re.Match) -> str:
+    return f"{_ABBREV_CANON[match.group(1)]} {match.group(2)}"
 
 
-def advanced_phonetic_match(s1: str, s2: str) -> float:
-    s1_clean = ''.join(c for c in s1.lower() if c.isalnum())
-    s2_clean = ''.join(c for c in s2.lower() if c.isalnum())
-    
-    if not s1_clean or not s2_clean:
-        return 0
-    
-    if s1_clean == s2_clean:
-        return 100
-    
-    consonant_groups = {
-        'ptkbdg': 'stop',
-        'fvszh': 'fricative',
-        'mnl': 'nasal',
-        'wy': 'glide'
-    }
-    
-    def simplify_sound(char):
-        for group, _ in consonant_groups.items():
-            if char in group:
-                return group[0]
-        return char
-    
-    s1_sound = ''.join(simplify_sound(c) for c in s1_clean)
-    s2_sound = ''.join(simplify_sound(c) for c in s2_clean)
-    
-    return fuzz.ratio(s1_sound, s2_sound)
+def normalize_abbreviations(text_lower: str) -> str:
+    return _ABBREV_RE.sub(_expand_abbreviation, text_lower)
+
+
+_NON_CONSONANT_RE = re.compile(r'[^bcdfghjklmnpqrstvwxyz]+')
+_NON_VOWEL_RE = re.compile(r'[^aeiou]+')
+_NON_ALNUM_RE = re.compile(r'[\W_]+')
+_CONSONANT_GROUPS = {
+    'ptkbdg': 'stop',
+    'fvszh': 'fricative',
+    'mnl': 'nasal',
+    'wy': 'glide'
+}
+# Each consonant maps to the first letter of its group, everything else passes through
+_SOUND_TABLE = str.maketrans({c: group[0] for group in _CONSONANT_GROUPS for c in group})
+
+
+def phonetic_keys(text_lower: str) -> tuple:
+    # (consonants, vowels, sound) strings, computed once per title at index time
+    consonants = _NON_CONSONANT_RE.sub('', text_lower)
+    vowels = _NON_VOWEL_RE.sub('', text_lower)
+    sound = _NON_ALNUM_RE.sub('', text_lower).translate(_SOUND_TABLE)
+    return consonants, vowels, sound
 
 
 def check_rate_limit(user_id: int) -> bool:
-    current_time = time.time()
+    # Monotonic so a wall-clock adjustment can neither lock users out nor skip the limit
+    current_time = time.monotonic()
     if user_id in user_last_action:
         if current_time - user_last_action[user_id] < RATE_LIMIT_SECONDS:
             return False
     user_last_action[user_id] = current_time
+    user_last_action.move_to_end(user_id)
+    # Kept in action order, so expired entries are always at the front
+    while current_time - next(iter(user_last_action.values())) >= RATE_LIMIT_SECONDS:
+        user_last_action.popitem(last=False)
     return True
 
+
+def get_user_session(user_id: int) -> Dict:
+    session = user_sessions.setdefault(user_id, {})
+    user_sessions.move_to_end(user_id)
+    if len(user_sessions) > USER_SESSIONS_SIZE:
+        user_sessions.popitem(last=False)
+    return session
+
 # check_user_membership function hata diya gaya hai
 
 
+def title_word_bits(vocab_bits: np.ndarray) -> np.ndarray:
+    # OR of vocab_bits over each title's words, for every title at once
+    word_ids = np.array(_title_word_ids, dtype=np.intp)
+    starts = np.array(_title_word_starts, dtype=np.intp)
+    # Trailing 0 keeps reduceat in bounds when the last titles have no words
+    bits = np.bitwise_or.reduceat(np.append(vocab_bits[word_ids], np.uint64(0)), starts[:-1])
+    bits[starts[1:] == starts[:-1]] = 0
+    return bits
+
+
+def result_dicts(ranked: List[tuple]) -> List[Dict]:
+    return [
+        {
+            "idx": idx,
+            "title": movies_cache[idx]['title'],
+            "file_id": movies_cache[idx]['file_id'],
+            "score": score
+        }
+        for idx, score in ranked
+    ]
+
+
 def advanced_fuzzy_search(query: str, limit: int = 15) -> List[Dict]:
     if not query or not movies_cache:
         return []
     
-    cache_key = query.lower().strip()
+    query_lower = query.lower().strip()
+    cache_key = (_catalog_generation, query_lower)
     if cache_key in search_cache:
         bot_stats["cache_hits"] += 1
-        return search_cache[cache_key][:limit]
+        search_cache.move_to_end(cache_key)
+        return result_dicts(search_cache[cache_key][:limit])
     
     bot_stats["total_searches"] += 1
-    query_lower = query.lower().strip()
     query_normalized = normalize_abbreviations(query_lower)
     query_words = query_normalized.split()
     
-    scored_movies = []
+    candidate_idxs = index_candidates(query_normalized)
+    if candidate_idxs is None:
+        candidate_idxs = range(len(movies_cache))
+    candidate_titles = [_normalized_titles[idx] for idx in candidate_idxs]
     
-    for movie in movies_cache:
-        title = movie['title']
-        title_lower = title.lower()
-        title_normalized = normalize_abbreviations(title_lower)
-        title_words = title_normalized.split()
-        
-        exact_match = title_normalized == query_normalized
-        starts_with = title_normalized.startswith(query_normalized)
-        contains = query_normalized in title_normalized
-        
-        ratio_score = fuzz.ratio(query_normalized, title_normalized)
-        partial_ratio = fuzz.partial_ratio(query_normalized, title_normalized)
-        token_sort = fuzz.token_sort_ratio(query_normalized, title_normalized)
-        token_set = fuzz.token_set_ratio(query_normalized, title_normalized)
-        
-        word_match_score = 0
-        if query_words and title_words:
-            matched_words = sum(1 for qw in query_words if any(fuzz.partial_ratio(qw, tw) > 75 for tw in title_words))
-            word_match_score = (matched_words / len(query_words)) * 100
-        
-        phonetic_score = phonetic_similarity(query_normalized, title_normalized)
-        adv_phonetic = advanced_phonetic_match(query_normalized, title_normalized)
-        
-        lev_dist = levenshtein_distance(query_normalized, title_normalized)
-        max_len = max(len(query_normalized), len(title_normalized))
-        lev_score = ((max_len - lev_dist) / max_len) * 100 if max_len > 0 else 0
-        
+    # One batched C++ call per scorer, combined as float32 vectors
+    scores = (
+        process.cdist([query_normalized], candidate_titles, scorer=fuzz.ratio)[0] * 0.20 +
+        process.cdist([query_normalized], candidate_titles, scorer=fuzz.partial_ratio)[0] * 0.18 +
+        process.cdist([query_normalized], candidate_titles, scorer=fuzz.token_sort_ratio)[0] * 0.15 +
+        process.cdist([query_normalized], candidate_titles, scorer=fuzz.token_set_ratio)[0] * 0.15
+    )
+    
+    # Phonetic scores compare the precomputed per-title keys in the same batched way
+    query_consonants, query_vowels, query_sound = phonetic_keys(query_normalized)
+    phonetic_scores = np.zeros(len(candidate_titles), dtype=np.float32)
+    adv_phonetic_scores = np.zeros(len(candidate_titles), dtype=np.float32)
+    if query_consonants:
+        title_consonants = [_title_consonants[idx] for idx in candidate_idxs]
+        title_vowels = [_title_vowels[idx] for idx in candidate_idxs]
+        vowel_scores = np.full(len(candidate_titles), 50, dtype=np.float32)
+        if query_vowels:
+            has_vowels = np.array([bool(v) for v in title_vowels], dtype=bool)
+            vowel_scores[has_vowels] = process.cdist([query_vowels], title_vowels, scorer=fuzz.ratio)[0][has_vowels]
+        phonetic_scores = process.cdist([query_consonants], title_consonants, scorer=fuzz.ratio)[0] * 0.7 + vowel_scores * 0.3
+        phonetic_scores[np.array([not c for c in title_consonants], dtype=bool)] = 0
+    if query_sound:
+        title_sounds = [_title_sounds[idx] for idx in candidate_idxs]
+        adv_phonetic_scores = process.cdist([query_sound], title_sounds, scorer=fuzz.ratio)[0]
+        adv_phonetic_scores[np.array([not s for s in title_sounds], dtype=bool)] = 0
+    
+    # Each distinct query word gets one bit, set on every vocabulary word it matches;
+    # one more bit marks words sharing the query's first three letters (64 bits in all,
+    # handle_search caps queries at 100 characters so the cap below never bites there)
+    distinct_words = list(dict.fromkeys(query_words))[:63]
+    prefix_bit = len(distinct_words)
+    vocab_bits = np.zeros(len(_vocab), dtype=np.uint64)
+    if _vocab and distinct_words:
+        word_hits = process.cdist(distinct_words, _vocab, scorer=fuzz.partial_ratio, score_cutoff=75) > 75
+        for bit, hits in enumerate(word_hits):
+            vocab_bits[hits] |= np.uint64(1 << bit)
+        prefix = query_words[0][:3]
+        vocab_bits[np.array([word.startswith(prefix) for word in _vocab], dtype=bool)] |= np.uint64(1 << prefix_bit)
+    title_bits = title_word_bits(vocab_bits)[candidate_idxs]
+    
+    word_match_scores = np.zeros(len(candidate_titles), dtype=np.float32)
+    for bit, word in enumerate(distinct_words):
+        word_match_scores += ((title_bits >> np.uint64(bit)) & np.uint64(1)) * query_words.count(word)
+    if query_words:
+        word_match_scores *= 100 / len(query_words)
+    
+    char_skip_scores = []
+    bonuses = []
+    query_chars = set(query_normalized.replace(' ', ''))
+    # Characters no title has never overlap, they only count towards the query's total
+    query_mask = 0
+    for c in query_chars:
+        query_mask |= _char_bits.get(c, 0)
+    
+    for pos, idx in enumerate(candidate_idxs):
+        title_normalized = candidate_titles[pos]
         char_skip_score = 0
-        query_chars = set(query_normalized.replace(' ', ''))
-        title_chars = set(title_normalized.replace(' ', ''))
-        if query_chars and title_chars:
-            char_overlap = len(query_chars & title_chars) / len(query_chars)
+        if query_chars:
+            char_overlap = (query_mask & _title_char_masks[idx]).bit_count() / len(query_chars)
             char_skip_score = char_overlap * 100
+        char_skip_scores.append(char_skip_score)
         
-        final_score = (
-            ratio_score * 0.20 +
-            partial_ratio * 0.18 +
-            token_sort * 0.15 +
-            token_set * 0.15 +
-            word_match_score * 0.12 +
-            phonetic_score * 0.08 +
-            adv_phonetic * 0.07 +
-            char_skip_score * 0.05
-        )
-        
-        if exact_match:
-            final_score += 300
-        elif starts_with:
-            final_score += 150
-        elif contains:
-            final_score += 80
-        
-        query_first_word = query_words[0] if query_words else ""
-        if query_first_word and any(tw.startswith(query_first_word[:3]) for tw in title_words):
-            final_score += 20
-        
-        if final_score > 25:
-            scored_movies.append({
-                "title": title,
-                "file_id": movie['file_id'],
-                "score": final_score
-            })
+        bonus = 0
+        if title_normalized == query_normalized:
+            bonus += 300
+        elif title_normalized.startswith(query_normalized):
+            bonus += 150
+        elif query_normalized in title_normalized:
+            bonus += 80
+        bonuses.append(bonus)
+    
+    scores += (
+        word_match_scores * 0.12 +
+        phonetic_scores * 0.08 +
+        adv_phonetic_scores * 0.07 +
+        np.array(char_skip_scores, dtype=np.float32) * 0.05 +
+        np.array(bonuses, dtype=np.float32) +
+        ((title_bits >> np.uint64(prefix_bit)) & np.uint64(1)) * 20
+    )
     
-    scored_movies.sort(key=lambda x: x['score'], reverse=True)
-    results = scored_movies[:limit]
+    # Top-k selection is O(N) with argpartition, only the survivors get sorted
+    passing = np.flatnonzero(scores > 25)
+    if len(passing) > limit:
+        passing = np.sort(passing[np.argpartition(-scores[passing], limit - 1)[:limit]])
+    top = passing[np.argsort(-scores[passing], kind='stable')]
     
-    search_cache[cache_key] = results
-    if len(search_cache) > 1000:
-        oldest_key = next(iter(search_cache))
-        del search_cache[oldest_key]
+    ranked = [(candidate_idxs[pos], float(scores[pos])) for pos in top.tolist()]
+    
+    search_cache[cache_key] = ranked
+    if len(search_cache) > SEARCH_CACHE_SIZE:
+        search_cache.popitem(last=False)
+    
+    return result_dicts(ranked)
+
+
+def search_keyboard(query: str) -> Optional[InlineKeyboardMarkup]:
+    # Buttons are rebuilt from the cached ranking every time, which costs microseconds
+    # and keeps cache entries at a few bytes per result
+    results = advanced_fuzzy_search(query, limit=15)
+    if not results:
+        return None
     
-    return results
+    keyboard_buttons = []
+    for result in results:
+        button_text = f"{result['title']} ({int(result['score'])}%)"
+        callback_data = f"movie_{result['idx']}"
+        keyboard_buttons.append([InlineKeyboardButton(text=button_text, callback_data=callback_data)])
+    return InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
 
 
 @dp.message(Command("start"))
@@ -413,15 +697,9 @@ You have full access to all bot features."""
     
     elif message.from_user and message.from_user.id not in verified_users:
         # Jab user verified nahi hai, tab hi join button dikhao
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text=f"🔗 Join Channel", url=f"https://t.me/{JOIN_CHANNEL_USERNAME.replace('@', '')}")],
-            [InlineKeyboardButton(text=f"👥 Join Group", url=f"https://t.me/{JOIN_GROUP_USERNAME.replace('@', '')}")],
-            [InlineKeyboardButton(text="✅ I Joined", callback_data="joined")]
-        ])
-        
         await message.answer(
             "Welcome! Please click 'I Joined' button below to continue:",
-            reply_markup=keyboard
+            reply_markup=JOIN_KEYBOARD
         )
     
     else:
@@ -458,7 +736,16 @@ async def cmd_refresh(message: Message):
         await message.answer("⛔ You are not authorized to use this command.")
         return
     
-    load_movies()
+    global _refreshes_in_progress
+    # File/S3 reads and JSON parsing run off the loop; the swap happens here
+    _refreshes_in_progress += 1
+    try:
+        movies = await asyncio.to_thread(read_movies)
+    finally:
+        _refreshes_in_progress -= 1
+    # Channel posts that arrived during the read are only in the journal so far
+    replay_movies_journal(movies)
+    load_movies(movies)
     search_cache.clear()
     await message.answer(f"✅ Refreshed! Loaded {len(movies_cache)} movies\n📇 Index: {len(movies_index)} terms")
 
@@ -527,47 +814,69 @@ Example:
         await message.answer("⚠️ No users in database yet.")
         return
     
-    sent_count = 0
-    failed_count = 0
-    blocked_count = 0
-    
     media_type = "📸 photo" if broadcast_photo else ("🎥 video" if broadcast_video else "📝 text")
     status_msg = await message.answer(f"📡 Broadcasting {media_type} to {len(users_database)} users...")
     
-    for user_id_str, user_data in users_database.items():
-        try:
-            user_id = int(user_id_str)
-            
-            if broadcast_photo:
-                await bot.send_photo(
-                    chat_id=user_id,
-                    photo=broadcast_photo,
-                    caption=f"📢 Broadcast:\n\n{broadcast_text}" if broadcast_text else "📢 Broadcast",
-                    parse_mode=ParseMode.HTML
-                )
-            elif broadcast_video:
-                await bot.send_video(
-                    chat_id=user_id,
-                    video=broadcast_video,
-                    caption=f"📢 Broadcast:\n\n{broadcast_text}" if broadcast_text else "📢 Broadcast",
-                    parse_mode=ParseMode.HTML
-                )
-            else:
-                await bot.send_message(
-                    chat_id=user_id,
-                    text=f"📢 Broadcast:\n\n{broadcast_text}",
-                    parse_mode=ParseMode.HTML
-                )
-            
-            sent_count += 1
-            await asyncio.sleep(0.05)
-        except Exception as e:
-            error_msg = str(e).lower()
-            if "blocked" in error_msg or "deactivated" in error_msg or "user is deactivated" in error_msg:
-                blocked_count += 1
-            else:
-                failed_count += 1
-            print(f"Failed to send to {user_id}: {e}")
+    semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    # Monotonic time until which every sender holds off, pushed out by any flood wait
+    resume_at = 0.0
+    
+    async def deliver(user_id: int):
+        if broadcast_photo:
+            await bot.send_photo(
+                chat_id=user_id,
+                photo=broadcast_photo,
+                caption=f"📢 Broadcast:\n\n{broadcast_text}" if broadcast_text else "📢 Broadcast",
+                parse_mode=ParseMode.HTML
+            )
+        elif broadcast_video:
+            await bot.send_video(
+                chat_id=user_id,
+                video=broadcast_video,
+                caption=f"📢 Broadcast:\n\n{broadcast_text}" if broadcast_text else "📢 Broadcast",
+                parse_mode=ParseMode.HTML
+            )
+        else:
+            await bot.send_message(
+                chat_id=user_id,
+                text=f"📢 Broadcast:\n\n{broadcast_text}",
+                parse_mode=ParseMode.HTML
+            )
+    
+    async def send_one(user_id: int) -> str:
+        nonlocal resume_at
+        async with semaphore:
+            for attempt in range(BROADCAST_RETRIES):
+                delay = resume_at - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                try:
+                    await deliver(user_id)
+                    status = "sent"
+                except TelegramRetryAfter as e:
+                    # Flood control is global, so all senders pause until Telegram's deadline
+                    status = "failed"
+                    resume_at = max(resume_at, time.monotonic() + e.retry_after)
+                    if attempt + 1 < BROADCAST_RETRIES:
+                        print(f"Rate limited sending to {user_id}, retrying in {e.retry_after}s")
+                        continue
+                    print(f"Rate limited sending to {user_id}, giving up")
+                except Exception as e:
+                    error_msg = str(e).lower()
+                    if "blocked" in error_msg or "deactivated" in error_msg or "user is deactivated" in error_msg:
+                        status = "blocked"
+                    else:
+                        status = "failed"
+                    print(f"Failed to send to {user_id}: {e}")
+                break
+            # Each slot is held for at least a second, capping the rate at BROADCAST_CONCURRENCY msg/s
+            await asyncio.sleep(1)
+            return status
+    
+    statuses = await asyncio.gather(*[send_one(int(user_id_str)) for user_id_str in list(users_database)])
+    sent_count = statuses.count("sent")
+    blocked_count = statuses.count("blocked")
+    failed_count = statuses.count("failed")
     
     summary = f"""✅ Broadcast Complete!
 
@@ -587,7 +896,7 @@ async def handle_channel_post(message: Message):
         if not message.chat:
             return
             
-        if message.chat.id == LIBRARY_CHANNEL_ID or (message.chat.username and message.chat.username.lower() == LIBRARY_CHANNEL_USERNAME.lower().replace('@', '')):
+        if message.chat.id == LIBRARY_CHANNEL_ID or (message.chat.username and message.chat.username.lower() == LIBRARY_CHANNEL_NAME):
             if message.document or message.video:
                 caption = message.caption or ""
                 title = caption.split('\n')[0].strip() if caption else "Unknown Movie"
@@ -620,14 +929,9 @@ async def handle_search(message: Message):
         user_id = message.from_user.id
         
         if user_id not in ADMIN_IDS and user_id not in verified_users:
-            keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text=f"🔗 Join Channel", url=f"https://t.me/{JOIN_CHANNEL_USERNAME.replace('@', '')}")],
-                [InlineKeyboardButton(text=f"👥 Join Group", url=f"https://t.me/{JOIN_GROUP_USERNAME.replace('@', '')}")],
-                [InlineKeyboardButton(text="✅ I Joined", callback_data="joined")]
-            ])
             await message.answer(
                 "🛑 **Access Denied!** Please click 'I Joined' button (or run /start) to use the search function.",
-                reply_markup=keyboard,
+                reply_markup=JOIN_KEYBOARD,
                 parse_mode=ParseMode.MARKDOWN
             )
             return
@@ -639,34 +943,18 @@ async def handle_search(message: Message):
             await message.answer("⚠️ Query too long. Please use less than 100 characters.")
             return
         
-        results = advanced_fuzzy_search(query, limit=15)
+        keyboard = search_keyboard(query)
         
-        if not results:
+        if not keyboard:
             await message.answer(f"❌ No movies found for: {query}\n\nTry checking the spelling or use a different name.")
             return
         
-        keyboard_buttons = []
-        for result in results:
-            try:
-                button_text = f"{result['title']} ({int(result['score'])}%)"
-                movie_idx = movies_cache.index([m for m in movies_cache if m['file_id'] == result['file_id']][0])
-                callback_data = f"movie_{movie_idx}"
-                keyboard_buttons.append([InlineKeyboardButton(text=button_text, callback_data=callback_data)])
-            except (ValueError, IndexError):
-                continue
-        
-        if not keyboard_buttons:
-            await message.answer(f"❌ No movies found for: {query}")
-            return
-        
-        keyboard = InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
-        
         sent_msg = await message.answer(
-            f"🔍 Found {len(keyboard_buttons)} results for: {query}",
+            f"🔍 Found {len(keyboard.inline_keyboard)} results for: {query}",
             reply_markup=keyboard
         )
         
-        user_sessions[message.from_user.id]['last_search_msg'] = sent_msg.message_id
+        get_user_session(message.from_user.id)['last_search_msg'] = sent_msg.message_id
     
     except Exception as e:
         print(f"Error in handle_search: {e}")
@@ -736,6 +1024,19 @@ async def send_movie(callback: types.CallbackQuery):
         except:
             pass
 
+@dp.startup()
+async def on_startup():
+    global _flush_task
+    _flush_task = asyncio.create_task(periodic_flush())
+
+
+@dp.shutdown()
+async def on_shutdown():
+    if _flush_task:
+        _flush_task.cancel()
+    await flush_users()
+    await flush_movies()
+
 # --- Koyeb/Flask Keep-Alive System ---
 
 app = Flask(__name__)